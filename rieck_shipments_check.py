@@ -1,12 +1,29 @@
-import os
 import re
+import struct
 import zipfile
+from collections.abc import Iterator
 from io import BytesIO
 from pathlib import Path
 
 import pandas as pd
 import streamlit as st
 
+try:
+    import pyarrow  # noqa: F401
+except ImportError:
+    _STRING_DTYPE = "string"
+else:
+    # Arrow-backed strings run .str ops as compiled kernels over one contiguous buffer
+    _STRING_DTYPE = "string[pyarrow]"
+
+try:
+    import python_calamine  # noqa: F401
+except ImportError:
+    _HAS_CALAMINE = False
+else:
+    # Rust reader for .xlsx/.xlsm/.xls; skips openpyxl's per-cell Python objects
+    _HAS_CALAMINE = True
+
 
 # --------------------------- Config ---------------------------
 st.set_page_config(page_title="Shipment Presence Checker", page_icon="📦", layout="wide")
@@ -18,6 +35,27 @@ INTRO = (
     "(e.g., `12345678_invoice.pdf`)."
 )
 
+# Rows sent to the browser for preview tables; downloads always hold everything
+PREVIEW_ROWS = 200
+
+# st.cache_data is shared by every session on the server; keep it small and
+# let entries for abandoned uploads expire.
+CACHE_ENTRIES = 4
+CACHE_TTL = 60 * 60  # seconds
+
+# ZIP record layouts (little-endian), see APPNOTE.TXT sections 4.3.12-4.3.16
+_ZIP_EOCD = struct.Struct("<4s4H2LH")
+_ZIP_EOCD64_LOCATOR = struct.Struct("<4sLQL")
+_ZIP_EOCD64 = struct.Struct("<4sQ2H2L4Q")
+_ZIP_CD_RECORD = struct.Struct("<4s6H3L5H2L")
+# Signature plus the name/extra/comment lengths of a central directory record
+_ZIP_CD_LENGTHS = struct.Struct("<L24x3H")
+
+_SHIP_PREFIX = re.compile(rb"^(\d{8})").match
+# Kept as a string: pandas' Arrow-backed .str.replace falls back to a Python
+# loop when handed a compiled pattern.
+_NONDIGIT = r"\D"
+
 # --------------------------- Helpers ---------------------------
 def extract_shipment_from_filename(filename: str) -> str | None:
     """
@@ -25,33 +63,31 @@ def extract_shipment_from_filename(filename: str) -> str | None:
     Example: '12345678_invoice.pdf' -> '12345678'
              'AB12345678.pdf'      -> None (not at start)
     """
-    base = os.path.basename(filename)
-    m = re.match(r"^(\d{8})", base)
-    return m.group(1) if m else None
+    base = filename.rpartition("/")[2].rpartition("\\")[2]
+    head = base[:8]
+    return head if len(head) == 8 and head.isascii() and head.isdigit() else None
 
 
-def clean_excel_shipment(val: object) -> str | None:
+def read_excel_shipment_column(uploaded_file, name: str) -> tuple[list[str], pd.DataFrame]:
     """
-    Keep digits only from Excel 'Shipment No.' values and accept exactly 8 digits.
-    """
-    if pd.isna(val):
-        return None
-    digits = re.sub(r"\D", "", str(val))
-    return digits if len(digits) == 8 else None
-
-
-def read_excel_shipment_column(uploaded_file) -> pd.Series:
-    """
-    Read the uploaded Excel and return a Series of cleaned 8-digit shipment numbers.
+    Read the uploaded Excel and return the unique cleaned 8-digit shipment numbers
+    (in sheet order) together with the rows that failed cleaning.
     Expects a column named exactly 'Shipment No.'.
-    Supports .xlsx/.xlsm (openpyxl) and .xls (xlrd).
+    Supports .xlsx/.xlsm/.xls (calamine), falling back to openpyxl / xlrd.
     """
-    name = uploaded_file.name.lower()
+    if _HAS_CALAMINE:
+        engine = "calamine"
+    else:
+        engine = "xlrd" if name.lower().endswith(".xls") else "openpyxl"
     try:
-        if name.endswith(".xls"):
-            df = pd.read_excel(uploaded_file, dtype=str, engine="xlrd")
-        else:
-            df = pd.read_excel(uploaded_file, dtype=str, engine="openpyxl")
+        # Parse only the one column we need; a callable (unlike a list) lets a
+        # missing column fall through to the friendly error below.
+        df = pd.read_excel(
+            uploaded_file,
+            dtype=str,
+            engine=engine,
+            usecols=lambda col: col == "Shipment No.",
+        )
     except Exception as e:
         st.error(f"Failed to read Excel: {e}")
         st.stop()
@@ -60,10 +96,11 @@ def read_excel_shipment_column(uploaded_file) -> pd.Series:
         st.error("Excel must contain a column named **'Shipment No.'** (exact match).")
         st.stop()
 
-    series = df["Shipment No."].map(clean_excel_shipment)
-    valid = series.dropna().drop_duplicates().astype(str)
-    invalid = df[series.isna()].copy()
-    invalid = invalid[["Shipment No."]] if "Shipment No." in invalid.columns else invalid
+    # Keep digits only and accept exactly 8 of them
+    digits = df["Shipment No."].astype(_STRING_DTYPE).str.replace(_NONDIGIT, "", regex=True)
+    valid_mask = (digits.str.len() == 8).fillna(False).astype(bool)
+    valid = digits[valid_mask].drop_duplicates().tolist()
+    invalid = df.loc[~valid_mask, ["Shipment No."]]
 
     return valid, invalid
 
@@ -73,32 +110,79 @@ def extract_from_uploaded_files(files) -> set[str]:
     From a list of UploadedFile objects, derive a set of 8-digit shipment numbers
     using the filename rule (first 8 digits at the start).
     """
-    shipments = set()
-    for f in files:
-        ship = extract_shipment_from_filename(f.name)
-        if ship:
-            shipments.add(ship)
-    return shipments
+    return {s for f in files if (s := extract_shipment_from_filename(f.name)) is not None}
 
 
-def extract_from_zip(uploaded_zip) -> set[str]:
+def _iter_zip_names(data) -> Iterator[bytes]:
+    """
+    Yield raw entry names from a ZIP's central directory, skipping directories.
+    Only the directory records are parsed; entry payloads are never touched.
     """
-    From an uploaded ZIP, derive a set of 8-digit shipment numbers by scanning entry names.
+    with memoryview(data) as view:
+        tail_start = max(0, len(view) - _ZIP_EOCD.size - 0xFFFF)
+        eocd = bytes(view[tail_start:]).rfind(b"PK\x05\x06")
+        if eocd < 0:
+            raise zipfile.BadZipFile("End of central directory record not found")
+        eocd += tail_start
+        cd_size = _ZIP_EOCD.unpack_from(view, eocd)[5]
+        cd_end = eocd
+
+        # ZIP64: the real directory size lives in the record just before the locator
+        locator = eocd - _ZIP_EOCD64_LOCATOR.size
+        if locator >= 0 and view[locator:locator + 4] == b"PK\x06\x07":
+            cd_end = locator - _ZIP_EOCD64.size
+            if cd_end < 0 or view[cd_end:cd_end + 4] != b"PK\x06\x06":
+                raise zipfile.BadZipFile("Corrupt ZIP64 end of central directory record")
+            cd_size = _ZIP_EOCD64.unpack_from(view, cd_end)[8]
+
+        # Locate the directory from its end so prepended data doesn't matter
+        offset = cd_end - cd_size
+        if offset < 0:
+            raise zipfile.BadZipFile("Central directory size out of range")
+        unpack_lengths = _ZIP_CD_LENGTHS.unpack_from
+        while offset < cd_end:
+            signature, name_len, extra_len, comment_len = unpack_lengths(view, offset)
+            if signature != 0x02014B50:
+                raise zipfile.BadZipFile("Bad central directory record signature")
+            start = offset + _ZIP_CD_RECORD.size
+            name = view[start:start + name_len].tobytes()
+            if not name.endswith(b"/"):
+                yield name
+            offset = start + name_len + extra_len + comment_len
+
+
+def extract_from_zip(data) -> set[str]:
+    """
+    From the raw bytes (or a buffer view) of an uploaded ZIP, derive a set of 8-digit shipment numbers
+    by scanning entry names.
     """
-    shipments = set()
     try:
-        with zipfile.ZipFile(uploaded_zip) as zf:
-            for info in zf.infolist():
-                if info.is_dir():
-                    continue
-                base = os.path.basename(info.filename)
-                ship = extract_shipment_from_filename(base)
-                if ship:
-                    shipments.add(ship)
+        # Same basename rule as extract_shipment_from_filename: split on / and \
+        bases = (name.rpartition(b"/")[2].rpartition(b"\\")[2] for name in _iter_zip_names(data))
+        # Dedupe the raw bytes first so each shipment is decoded once
+        prefixes = {m.group(1) for m in map(_SHIP_PREFIX, bases) if m}
     except Exception as e:
         st.error(f"Failed to read ZIP: {e}")
         st.stop()
-    return shipments
+    return {p.decode("ascii") for p in prefixes}
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_ENTRIES, ttl=CACHE_TTL)
+def _read_excel_cached(data: bytes, name: str) -> tuple[list[str], pd.DataFrame]:
+    """
+    read_excel_shipment_column keyed on the file bytes, so reruns skip re-parsing.
+    """
+    return read_excel_shipment_column(BytesIO(data), name)
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_ENTRIES, ttl=CACHE_TTL)
+def _extract_from_zip_cached(file_id: str, _uploaded_zip) -> set[str]:
+    """
+    extract_from_zip keyed on the upload's file_id rather than its bytes, so large
+    archives are neither hashed nor copied; the scan reads the upload buffer in place.
+    """
+    with _uploaded_zip.getbuffer() as view:
+        return extract_from_zip(view)
 
 
 def df_to_xlsx_bytes(df: pd.DataFrame, sheet_name="Missing", file_name="missing_shipments.xlsx") -> tuple[bytes, str]:
@@ -106,12 +190,39 @@ def df_to_xlsx_bytes(df: pd.DataFrame, sheet_name="Missing", file_name="missing_
     Convert a DataFrame to a downloadable XLSX (bytes, filename).
     """
     buf = BytesIO()
-    with pd.ExcelWriter(buf, engine="openpyxl") as writer:
+    # constant_memory flushes each row as soon as the next one starts, but pandas
+    # writes cells column by column, so it is only safe for single-column frames.
+    options = {"constant_memory": True} if len(df.columns) <= 1 else {}
+    with pd.ExcelWriter(buf, engine="xlsxwriter", engine_kwargs={"options": options}) as writer:
         df.to_excel(writer, index=False, sheet_name=sheet_name)
     buf.seek(0)
     return buf.read(), file_name
 
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_ENTRIES, ttl=CACHE_TTL)
+def _missing_xlsx_cached(input_ids: tuple, _missing_df: pd.DataFrame) -> bytes:
+    """
+    Build the Missing Shipments XLSX once per set of uploads.
+    """
+    return df_to_xlsx_bytes(_missing_df, sheet_name="Missing")[0]
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_ENTRIES, ttl=CACHE_TTL)
+def _summary_xlsx_cached(input_ids: tuple, _valid_shipments: list[str], _folder_shipments: set[str]) -> bytes:
+    """
+    Build the full presence summary (Summary + FolderSet sheets) once per set of
+    uploads, so reruns such as clicking its download button reuse the bytes.
+    """
+    present = [s in _folder_shipments for s in _valid_shipments]
+    result_df = pd.DataFrame({"Shipment No.": _valid_shipments, "Present": present})
+    folder_df = pd.DataFrame({"FolderShipments": sorted(_folder_shipments)})
+    buf = BytesIO()
+    with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
+        result_df.to_excel(writer, index=False, sheet_name="Summary")
+        folder_df.to_excel(writer, index=False, sheet_name="FolderSet")
+    return buf.getvalue()
+
+
 # --------------------------- UI ---------------------------
 st.title(TITLE)
 st.caption(INTRO)
@@ -123,7 +234,7 @@ with st.expander("How it works", expanded=False):
         1. Upload the Excel that contains a column named **`Shipment No.`** (your column B). Create this file in BC from the list Posted Warehouse Shipments. (Filter for Rieck, and customer NOT Nordisk)
         2. Provide the processed files either by **uploading multiple files** or **uploading a ZIP of the processed folder**. (Download all the Posted Sales Shipment files from Rieck > Processed folder on SharePoint)
         3. Click **Run check** to compare.
-        4. Download the **Missing Shipments** as an Excel file.
+        4. Download the **Missing Shipments** as a CSV file (an Excel version is available under **Need .xlsx?**).
 
         **Rules & Notes**
         - A processed file counts for a shipment if its **filename starts with 8 digits** (e.g., `12345678_document.pdf`).
@@ -162,66 +273,83 @@ with st.sidebar:
     st.header("Options")
     show_preview = st.checkbox("Show preview tables", value=True)
 
-run = st.button(
-    "▶️ Run check",
-    type="primary",
-    disabled=excel_file is None or ((uploaded_files is None or len(uploaded_files) == 0) and uploaded_zip is None),
+inputs_missing = excel_file is None or ((uploaded_files is None or len(uploaded_files) == 0) and uploaded_zip is None)
+run = st.button("▶️ Run check", type="primary", disabled=inputs_missing)
+
+# Keep showing results after the click so widgets below (e.g. the full summary
+# checkbox) can rerun the script; parsing is cached, so reruns are cheap.
+# New or removed uploads reset the check and any opted-in exports.
+input_ids = (
+    excel_file.file_id if excel_file is not None else None,
+    uploaded_zip.file_id if uploaded_zip is not None else None,
+    tuple(f.file_id for f in uploaded_files or []),
 )
+if st.session_state.get("input_ids") != input_ids:
+    st.session_state["input_ids"] = input_ids
+    for key in ("checked", "want_xlsx", "want_full"):
+        st.session_state.pop(key, None)
+if run:
+    st.session_state["checked"] = True
 
 # --------------------------- Logic ---------------------------
-if run:
+if st.session_state.get("checked"):
     # Read Excel shipments
-    valid_shipments, invalid_rows = read_excel_shipment_column(excel_file)
-    if valid_shipments.empty:
+    valid_shipments, invalid_rows = _read_excel_cached(excel_file.getvalue(), excel_file.name)
+    if not valid_shipments:
         st.warning("No valid 8-digit shipment numbers found in Excel after cleaning.")
         st.stop()
 
     # Read processed files (filenames only)
     if uploaded_zip is not None:
-        folder_shipments = extract_from_zip(uploaded_zip)
+        folder_shipments = _extract_from_zip_cached(uploaded_zip.file_id, uploaded_zip)
     else:
         folder_shipments = extract_from_uploaded_files(uploaded_files or [])
 
     # Compare sets
-    folder_set = set(folder_shipments)
-    present_mask = valid_shipments.isin(folder_set)
-    result_df = pd.DataFrame({"Shipment No.": valid_shipments.values, "Present": present_mask.values})
-    missing_df = result_df[~result_df["Present"]].drop(columns=["Present"]).reset_index(drop=True)
+    missing_df = pd.DataFrame({"Shipment No.": [s for s in valid_shipments if s not in folder_shipments]})
 
     # Metrics
     st.success("Done!")
     c1, c2, c3 = st.columns(3)
-    c1.metric("Unique shipments in folder", f"{len(folder_set):,}")
+    c1.metric("Unique shipments in folder", f"{len(folder_shipments):,}")
     c2.metric("Unique shipments in Excel", f"{len(valid_shipments):,}")
     c3.metric("Missing shipments", f"{len(missing_df):,}")
 
     # Previews
     if show_preview:
         st.subheader("Missing shipments (preview)")
-        st.dataframe(missing_df, use_container_width=True, height=320)
+        if len(missing_df) > PREVIEW_ROWS:
+            st.caption(f"Showing the first {PREVIEW_ROWS:,} rows; download the file for the full list.")
+        st.dataframe(missing_df.head(PREVIEW_ROWS), use_container_width=True, height=320)
 
         if not invalid_rows.empty:
             st.subheader("Rows with invalid 'Shipment No.' (not exactly 8 digits after cleaning)")
             st.dataframe(invalid_rows, use_container_width=True, height=240)
 
     # Downloads
-    xlsx_bytes, fname = df_to_xlsx_bytes(missing_df, sheet_name="Missing", file_name="missing_shipments.xlsx")
     st.download_button(
-        "⬇️ Download Missing Shipments (Excel)",
-        data=xlsx_bytes,
-        file_name=fname,
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "⬇️ Download Missing Shipments (CSV)",
+        data=missing_df.to_csv(index=False).encode("utf-8"),
+        file_name="missing_shipments.csv",
+        mime="text/csv",
     )
 
+    with st.expander("Need .xlsx?"):
+        # Expander bodies always run, so the XLSX is only built once asked for
+        if st.checkbox("Prepare .xlsx", key="want_xlsx"):
+            st.download_button(
+                "⬇️ Download Missing Shipments (Excel)",
+                data=_missing_xlsx_cached(input_ids, missing_df),
+                file_name="missing_shipments.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )
+
     with st.expander("Advanced: Download full presence summary"):
-        full_buf = BytesIO()
-        with pd.ExcelWriter(full_buf, engine="openpyxl") as writer:
-            result_df.to_excel(writer, index=False, sheet_name="Summary")
-            pd.DataFrame({"FolderShipments": sorted(folder_set)}).to_excel(writer, index=False, sheet_name="FolderSet")
-        full_buf.seek(0)
-        st.download_button(
-            "⬇️ Download Full Summary (Excel)",
-            data=full_buf.read(),
-            file_name="shipment_presence_summary.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        )
+        # Writing the whole folder set is the slowest step, so only do it on request
+        if st.checkbox("Prepare full summary", key="want_full"):
+            st.download_button(
+                "⬇️ Download Full Summary (Excel)",
+                data=_summary_xlsx_cached(input_ids, valid_shipments, folder_shipments),
+                file_name="shipment_presence_summary.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )